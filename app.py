@@ -1,13 +1,24 @@
 import os
-import json
-import base64
+import orjson
+import pybase64
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from hashlib import blake2b
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import io
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from pdf2image import convert_from_bytes
-from flask import Flask, render_template, request, jsonify, send_file, session
+from pdf2image import convert_from_path
+from flask import Flask, Request, Response, render_template, request, jsonify, session
+from flask_session import Session
+from cachelib import FileSystemCache
+from flask_compress import Compress
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -17,9 +28,96 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 app = Flask(__name__)
 app.secret_key = os.urandom(24) 
 
+# Keep timetable data server-side; the cookie only carries the session id
+# Stored sessions expire after PERMANENT_SESSION_LIFETIME even when not
+# permanent; a day covers upload -> review -> export. The threshold is well
+# above a day's sessions so cachelib never prunes live timetables.
+app.config['SESSION_TYPE'] = 'cachelib'
+app.config['SESSION_CACHELIB'] = FileSystemCache(
+    os.path.join(tempfile.gettempdir(), 'timetable_sessions'),
+    threshold=20000
+)
+app.config['SESSION_PERMANENT'] = False
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=1)
+Session(app)
+
+# Compress JSON and calendar responses (brotli when the client supports it)
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 512
+app.config['COMPRESS_MIMETYPES'] = [
+    'text/html', 'text/css', 'text/javascript', 'application/json', 'text/calendar'
+]
+Compress(app)
+
+# Reject oversize uploads at the WSGI layer before the body is buffered
+MAX_UPLOAD_SIZE = 4 * 1024 * 1024
+FORM_OVERHEAD_ALLOWANCE = 64 * 1024  # Multipart boundaries and headers
+BATCH_MAX_FILES = 10
+BATCH_MAX_CONTENT_LENGTH = BATCH_MAX_FILES * (MAX_UPLOAD_SIZE + FORM_OVERHEAD_ALLOWANCE)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE + FORM_OVERHEAD_ALLOWANCE
+
+class UploadRequest(Request):
+    """Request that keeps bounded uploads in memory instead of spilling to disk."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        limit = self.max_content_length
+        if total_content_length is not None and limit is not None and total_content_length <= limit:
+            return io.BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = UploadRequest
+
 # --- Constants & Configuration ---
 GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
 GROQ_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"  # Current Groq vision model
+GROQ_FILES_URL = "https://api.groq.com/openai/v1/files"
+GROQ_BATCHES_URL = "https://api.groq.com/openai/v1/batches"
+GROQ_BATCH_WINDOW = "24h"
+GROQ_TIMEOUT = (5, 60)  # (connect, read) seconds
+
+# Shared session so uploads reuse pooled keep-alive connections to Groq
+# instead of paying a TCP + TLS handshake on every request
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        # Default allowed_methods excludes POST, so an inference request that
+        # reached Groq (5xx, read timeout) is never replayed or billed twice;
+        # only connection failures, where nothing was sent, are retried
+        raise_on_status=False  # Hand the last response to raise_for_status()
+    )
+))
+
+# Batch file uploads and job creation are never retried: replaying one that
+# Groq already accepted would queue a duplicate (and billed) batch job
+BATCH_HTTP_SESSION = requests.Session()
+BATCH_HTTP_SESSION.mount('https://', HTTPAdapter(max_retries=0))
+
+# Compiled once; used to pull the JSON out of the model's reply
+JSON_OBJECT_PATTERN = re.compile(r'\{.*\}', re.DOTALL)
+CODE_FENCE_PATTERN = re.compile(r'^```(?:json)?\s*|\s*```$', re.MULTILINE)
+
+ICS_APP_ID = "flask-timetable-pro"
+ICS_CACHE_MAX_AGE = 300  # Seconds calendar clients may reuse a fetched .ics
+
+# In-process LRU of generated calendars. Bounded by entry count and entry
+# size (at most 256 x 64K characters per worker); large timetables are never cached.
+ICS_CACHE = OrderedDict()
+ICS_CACHE_LOCK = threading.Lock()
+ICS_CACHE_MAX_ENTRIES = 256
+ICS_CACHE_MAX_ENTRY_SIZE = 64 * 1024  # Characters of ICS content
+ICS_CACHE_MAX_EVENTS = 300
+# DTSTAMP changes on every generation, so it is left out of the ETag
+DTSTAMP_LINE_PATTERN = re.compile(r'^DTSTAMP:.*$', re.MULTILINE)
+
+PDF_MAX_PAGES = 5  # Only the first pages are rasterized and sent
+PDF_DPI = 110  # Plenty for printed timetable text, ~half the pixels of 150
+PDF_MAX_SIDE = 1600  # Pages larger than this (e.g. A3 posters) are downscaled
+PDF_JPEG_OPTIONS = {"quality": 80, "progressive": False, "optimize": True}
 
 
 
@@ -30,71 +128,116 @@ TIMETABLE_ENTRY_SCHEMA = {
     "subject": {"type": "string"}, 
     "location": {"type": "string"}
 }
+REQUIRED_ENTRY_KEYS = frozenset(TIMETABLE_ENTRY_SCHEMA)
+
+# 0=Monday ... 6=Sunday (matches datetime.weekday() and ISO weeks)
+DAY_INDEX = {
+    day: index for index, day in enumerate(
+        ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+    )
+}
 
 # --- Utility Functions ---
 
 def file_to_base64(file_storage):
     """Converts a Flask FileStorage object to a Base64 string and MIME type."""
-    file_bytes = file_storage.read()
     mime_type = file_storage.mimetype
-    base64_string = base64.b64encode(file_bytes).decode('utf-8')
+    file_storage.stream.seek(0)
+    base64_string = pybase64.b64encode_as_string(file_storage.stream.read())
     return base64_string, mime_type
 
-def get_next_occurrence_date(item: dict, is_start: bool) -> datetime | None:
-    """Finds the next occurrence date for a given day and time."""
-    days_of_week = ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday']
-    target_day_index = days_of_week.index(item['day'].lower()) if item['day'].lower() in days_of_week else -1
-    
-    if target_day_index == -1:
+def strip_code_fences(text: str) -> str:
+    """Removes markdown code fences (```json ... ```) around a model reply."""
+    return CODE_FENCE_PATTERN.sub('', text).strip()
+
+def pdf_page_is_oversized(page_path: str) -> bool:
+    """Checks whether a rasterized PDF page exceeds PDF_MAX_SIDE."""
+    # Image.open only reads the header, so this check is cheap
+    with Image.open(page_path) as img:
+        return max(img.size) > PDF_MAX_SIDE
+
+def pdf_page_to_base64(page_path: str) -> str:
+    """Base64-encodes poppler's JPEG for a PDF page as-is."""
+    with open(page_path, 'rb') as page_file:
+        return pybase64.b64encode_as_string(page_file.read())
+
+def downscaled_pdf_page_to_base64(page_path: str) -> str:
+    """Downscales an oversized PDF page to PDF_MAX_SIDE and base64-encodes it."""
+    with Image.open(page_path) as img:
+        img.thumbnail((PDF_MAX_SIDE, PDF_MAX_SIDE), Image.LANCZOS)
+        buffered = io.BytesIO()
+        img.save(
+            buffered,
+            format="JPEG",
+            quality=PDF_JPEG_OPTIONS["quality"],
+            optimize=PDF_JPEG_OPTIONS["optimize"],
+            progressive=PDF_JPEG_OPTIONS["progressive"]
+        )
+        return pybase64.b64encode_as_string(buffered.getvalue())
+
+def parse_time_range(time_str: str) -> tuple[int, int, int, int] | None:
+    """Parses 'HH:MM-HH:MM' into (start_hour, start_minute, end_hour, end_minute)."""
+    try:
+        start_str, end_str = time_str.split('-', 1)
+        start_hour, start_minute = map(int, start_str.split(':'))
+        end_hour, end_minute = map(int, end_str.split(':'))
+    except ValueError:
+        return None
+    return start_hour, start_minute, end_hour, end_minute
+
+def get_occurrence_range(item: dict, week_start: datetime) -> tuple[datetime, datetime] | None:
+    """Finds the start and end datetimes of an item within the week starting at week_start."""
+    target_day_index = DAY_INDEX.get(item['day'].lower())
+    if target_day_index is None:
         return None
 
+    time_range = parse_time_range(item['time']) if isinstance(item['time'], str) else None
+    if time_range is None:
+        return None
+    start_hour, start_minute, end_hour, end_minute = time_range
+
+    # Anchoring on the week (rather than "now") keeps the output identical
+    # for the whole week; the weekly RRULE covers every later occurrence
+    day = week_start + timedelta(days=target_day_index)
     try:
-        time_str = item['time'].split('-')[0] if is_start else item['time'].split('-')[1]
-        hour, minute = map(int, time_str.split(':'))
-    except (IndexError, ValueError):
+        start = day.replace(hour=start_hour, minute=start_minute)
+        end = day.replace(hour=end_hour, minute=end_minute)
+    except ValueError:
         return None
 
-    now = datetime.now()
-    
-    # Calculate days until next target day
-    today_index = now.weekday()  # Monday is 0, Sunday is 6
-    # Convert to 0=Sunday, 1=Monday... to match days_of_week array
-    today_index = (today_index + 1) % 7
-    
-    diff = (target_day_index - today_index + 7) % 7
-    
-    # Check if it's today and the time has already passed
-    if diff == 0:
-        check_time = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
-        if check_time < now:
-             diff = 7 # Move to next week
-
-    date = now + timedelta(days=diff)
-    date = date.replace(hour=hour, minute=minute, second=0, microsecond=0)
-    
-    return date
+    return start, end
 
 def format_date_to_calendar(d: datetime) -> str:
     """Formats a datetime object to YYYYMMDDTHHMMSS for iCalendar."""
-    # iCalendar format: YYYYMMDDTHHMMSS 
-    return d.strftime('%Y%m%dT%H%M%S')
-
-def generate_ics_content(timetable_data: list[dict], app_id: str) -> str:
-    """Generates the full iCalendar content."""
-    ics_content = (
-        "BEGIN:VCALENDAR\n"
-        "VERSION:2.0\n"
-        "PRODID:-//Timetable Organizer//EN\n"
-        "CALSCALE:GREGORIAN\n"
-        "X-WR-CALNAME:My University Timetable\n"
-    )
+    # iCalendar format: YYYYMMDDTHHMMSS (f-string avoids strftime's locale overhead)
+    return f"{d.year:04d}{d.month:02d}{d.day:02d}T{d.hour:02d}{d.minute:02d}{d.second:02d}"
+
+def get_week_start(now: datetime) -> datetime:
+    """Returns midnight on the Monday of now's ISO week."""
+    return (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+
+def generate_ics_content(
+    timetable_data: list[dict], app_id: str, week_start: datetime, generated_at: datetime
+) -> str:
+    """Generates the full iCalendar content for events anchored on week_start.
+
+    All clock-dependent values are passed in, so the output is a pure
+    function of the arguments.
+    """
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//Timetable Organizer//EN",
+        "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:My University Timetable"
+    ]
     
     day_map = {
         'monday': 'MO', 'tuesday': 'TU', 'wednesday': 'WE', 'thursday': 'TH', 
         'friday': 'FR', 'saturday': 'SA', 'sunday': 'SU'
     }
 
-    dt_stamp_utc = format_date_to_calendar(datetime.utcnow()) + 'Z'
+    dt_stamp_utc = format_date_to_calendar(generated_at.astimezone(timezone.utc)) + 'Z'
 
     for index, item in enumerate(timetable_data):
         day_key = item['day'].lower()
@@ -103,11 +246,10 @@ def generate_ics_content(timetable_data: list[dict], app_id: str) -> str:
         if not day_to_ics:
             continue
 
-        startDate = get_next_occurrence_date(item, True)
-        endDate = get_next_occurrence_date(item, False)
-        
-        if not startDate or not endDate:
+        occurrence = get_occurrence_range(item, week_start)
+        if not occurrence:
             continue
+        startDate, endDate = occurrence
 
         dtStart = format_date_to_calendar(startDate)
         dtEnd = format_date_to_calendar(endDate)
@@ -116,88 +258,88 @@ def generate_ics_content(timetable_data: list[dict], app_id: str) -> str:
         summary = item['subject'].replace(',', r'\,')
         location = item['location'].replace(',', r'\,') if item['location'] else ''
 
-        ics_content += "BEGIN:VEVENT\n"
-        ics_content += f"UID:{dtStart}-{index}@{app_id}\n"
-        ics_content += f"DTSTAMP:{dt_stamp_utc}\n"
-        ics_content += f"DTSTART:{dtStart}\n"
-        ics_content += f"DTEND:{dtEnd}\n"
-        ics_content += f"SUMMARY:{summary}\n"
-        if location:
-            ics_content += f"LOCATION:{location}\n"
-        ics_content += f"DESCRIPTION:Generated from Timetable Organizer. Automatically repeats weekly.\n"
-        ics_content += f"RRULE:FREQ=WEEKLY;BYDAY={day_to_ics}\n"
-        ics_content += "END:VEVENT\n"
+        location_line = f"LOCATION:{location}\r\n" if location else ''
+
+        # One pre-joined entry per event keeps the list to ~len(timetable_data)
+        lines.append(
+            "BEGIN:VEVENT\r\n"
+            f"UID:{dtStart}-{index}@{app_id}\r\n"
+            f"DTSTAMP:{dt_stamp_utc}\r\n"
+            f"DTSTART:{dtStart}\r\n"
+            f"DTEND:{dtEnd}\r\n"
+            f"SUMMARY:{summary}\r\n"
+            f"{location_line}"
+            "DESCRIPTION:Generated from Timetable Organizer. Automatically repeats weekly.\r\n"
+            f"RRULE:FREQ=WEEKLY;BYDAY={day_to_ics}\r\n"
+            "END:VEVENT"
+        )
         
-    ics_content += "END:VCALENDAR"
-    return ics_content
-
-# --- Flask Routes ---
-
-@app.route('/')
-def index():
-    """Initial route to render the main template and initialize session data."""
-    # Initialize session data if not present
-    if 'timetable_data' not in session:
-        session['timetable_data'] = []
-    if 'current_step' not in session:
-        session['current_step'] = 1
-    
-    # Pass initial data to the frontend
-    return render_template('index.html', initial_data={
-        'timetableData': session['timetable_data'],
-        'currentStep': session['current_step']
-    })
-
-@app.route('/api/upload_and_analyze', methods=['POST'])
-def upload_and_analyze():
-    """Handles file upload, calls Gemini API, and stores results in session."""
-    if 'file' not in request.files:
-        return jsonify({'success': False, 'message': 'No file part'}), 400
-
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'success': False, 'message': 'No selected file'}), 400
-    
-    if file.content_length > 4 * 1024 * 1024:
-        return jsonify({'success': False, 'message': 'File size must be under 4MB.'}), 400
-
-    if not (file.mimetype.startswith('image/') or file.mimetype == 'application/pdf'):
-        return jsonify({'success': False, 'message': 'Please upload an image or PDF file.'}), 400
-
-    try:
-        image_parts = []
-        if file.mimetype == 'application/pdf':
-            # Convert PDF pages to images
-            pdf_bytes = file.read()
-            images = convert_from_bytes(pdf_bytes)
-            # Limit to first 5 pages to avoid massive payloads
-            for img in images[:5]:
-                buffered = io.BytesIO()
-                img.save(buffered, format="JPEG")
-                img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    lines.append("END:VCALENDAR")
+    # RFC 5545 requires CRLF line endings
+    return "\r\n".join(lines) + "\r\n"
+
+def file_to_image_parts(file) -> list[dict]:
+    """Converts an uploaded image or PDF into Groq image_url message parts."""
+    image_parts = []
+    if file.mimetype == 'application/pdf':
+        # Convert PDF pages to images
+        with tempfile.TemporaryDirectory() as output_dir:
+            # Spool the upload to disk in small chunks so poppler reads the
+            # file itself rather than a full in-memory copy of it
+            pdf_path = os.path.join(output_dir, 'upload.pdf')
+            file.save(pdf_path)
+
+            # Let poppler write JPEGs directly (no PIL re-encode) and only
+            # rasterize the pages we send, to avoid massive payloads
+            page_paths = convert_from_path(
+                pdf_path,
+                dpi=PDF_DPI,
+                fmt='jpeg',
+                jpegopt=PDF_JPEG_OPTIONS,
+                first_page=1,
+                last_page=PDF_MAX_PAGES,
+                thread_count=min(PDF_MAX_PAGES, os.cpu_count() or 1),
+                output_folder=output_dir,
+                paths_only=True,
+                use_pdftocairo=True
+            )
+            # Most pages fit PDF_MAX_SIDE at PDF_DPI and are sent as poppler
+            # wrote them; only several oversized pages (e.g. A3 posters) are
+            # worth a thread pool, as PIL releases the GIL while re-encoding
+            oversized_paths = [path for path in page_paths if pdf_page_is_oversized(path)]
+            if len(oversized_paths) > 1:
+                with ThreadPoolExecutor(max_workers=len(oversized_paths)) as executor:
+                    downscaled = dict(zip(
+                        oversized_paths,
+                        executor.map(downscaled_pdf_page_to_base64, oversized_paths)
+                    ))
+            else:
+                downscaled = {path: downscaled_pdf_page_to_base64(path) for path in oversized_paths}
+
+            page_base64s = [
+                downscaled[path] if path in downscaled else pdf_page_to_base64(path)
+                for path in page_paths
+            ]
+
+            for img_base64 in page_base64s:
                 image_parts.append({
                     "type": "image_url",
                     "image_url": {
                         "url": f"data:image/jpeg;base64,{img_base64}"
                     }
                 })
-        else:
-            base64_image, mime_type = file_to_base64(file)
-            image_parts.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:{mime_type};base64,{base64_image}"
-                }
-            })
-    except Exception as e:
-        return jsonify({'success': False, 'message': f'File reading/conversion error: {str(e)}'}), 500
-
-
-    # Groq API Call Logic
-    api_key = GROQ_API_KEY
-    if not api_key:
-        return jsonify({'success': False, 'message': 'GROQ_API_KEY is not configured on the server.'}), 500
+    else:
+        base64_image, mime_type = file_to_base64(file)
+        image_parts.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{mime_type};base64,{base64_image}"
+            }
+        })
+    return image_parts
 
+def build_analysis_payload(image_parts: list[dict]) -> dict:
+    """Builds the Groq chat completion payload for timetable extraction."""
     system_instruction = (
         "You are an elite timetable parsing intelligence. Your goal is to convert any visual timetable (grid, list, or freeform) into a strict JSON format.\n\n"
         "### EXTRACTION RULES:\n"
@@ -212,7 +354,7 @@ def upload_and_analyze():
         "Do not include any preamble, markdown formatting, or explanations."
     )
     
-    payload = {
+    return {
         "model": GROQ_MODEL,
         "messages": [
             {
@@ -233,45 +375,162 @@ def upload_and_analyze():
         "temperature": 0
     }
 
+def parse_timetable_reply(result: dict) -> list:
+    """Extracts the timetable entries from a Groq chat completion response."""
+    # Grok response structure (OpenAI-compatible)
+    content_text = result.get('choices', [{}])[0].get('message', {}).get('content', '')
+
+    if not content_text:
+        raise ValueError("API response was empty or malformed.")
+
+    # Grok might return just the array or a wrapped object depending on prompt
+    # But we requested json_object, so it should be a valid JSON string.
+    # Robust JSON extraction: Handle markdown blocks if the AI includes them
+    json_match = JSON_OBJECT_PATTERN.search(content_text)
+    if json_match:
+        try:
+            parsed_json = orjson.loads(json_match.group())
+        except orjson.JSONDecodeError:
+            # Fallback to simple load if regex extraction fails
+            parsed_json = orjson.loads(strip_code_fences(content_text))
+    else:
+        parsed_json = orjson.loads(strip_code_fences(content_text))
+
+    if isinstance(parsed_json, dict) and "timetable" in parsed_json:
+        valid_data = parsed_json["timetable"]
+    elif isinstance(parsed_json, list):
+        valid_data = parsed_json
+    else:
+        valid_data = [parsed_json] if isinstance(parsed_json, dict) else []
+    return valid_data
+
+def validate_upload(file) -> str | None:
+    """Returns an error message if the uploaded file can't be analyzed."""
+    if file.filename == '':
+        return 'No selected file'
+    
+    # Part headers rarely carry a length, so measure the (in-memory) stream
+    file.stream.seek(0, os.SEEK_END)
+    file_size = file.stream.tell()
+    file.stream.seek(0)
+    if file_size > MAX_UPLOAD_SIZE:
+        return 'File size must be under 4MB.'
+
+    if not (file.mimetype.startswith('image/') or file.mimetype == 'application/pdf'):
+        return 'Please upload an image or PDF file.'
+
+    return None
+
+def generate_ics_cached(timetable_data: list[dict], app_id: str, week_start: datetime) -> str:
+    """generate_ics_content memoized per (timetable digest, week), for small timetables."""
+    generated_at = datetime.now(timezone.utc)  # DTSTAMP of a freshly built calendar
+    if len(timetable_data) > ICS_CACHE_MAX_EVENTS:
+        return generate_ics_content(timetable_data, app_id, week_start, generated_at)
+
+    # Key on a digest so cached entries don't pin the (possibly large) input
+    digest = blake2b(orjson.dumps(timetable_data), digest_size=16).digest()
+    cache_key = (digest, app_id, week_start)
+    with ICS_CACHE_LOCK:
+        ics_content = ICS_CACHE.get(cache_key)
+        if ics_content is not None:
+            ICS_CACHE.move_to_end(cache_key)
+            return ics_content
+
+    ics_content = generate_ics_content(timetable_data, app_id, week_start, generated_at)
+    if len(ics_content) <= ICS_CACHE_MAX_ENTRY_SIZE:
+        with ICS_CACHE_LOCK:
+            ICS_CACHE[cache_key] = ics_content
+            if len(ICS_CACHE) > ICS_CACHE_MAX_ENTRIES:
+                ICS_CACHE.popitem(last=False)
+    return ics_content
+
+def ics_etag(ics_content: str) -> str:
+    """Hashes the calendar content, ignoring the per-request DTSTAMP lines."""
+    stable_content = DTSTAMP_LINE_PATTERN.sub('', ics_content)
+    return blake2b(stable_content.encode('utf-8'), digest_size=16).hexdigest()
+
+def ics_response(timetable_data: list[dict], disposition: str) -> Response:
+    """Builds the .ics response, answering 304 if the client's copy is current."""
+    # Repeat downloads of an unchanged timetable within a week hit the cache
+    ics_content = generate_ics_cached(timetable_data, ICS_APP_ID, get_week_start(datetime.now()))
+    etag = ics_etag(ics_content)
+
+    # Weak validator: DTSTAMP is excluded from the hash, so bodies under one
+    # tag are equivalent but not byte-identical (Flask-Compress also leaves
+    # weak tags unchanged, so the tag matches for every encoding)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(
+            ics_content,
+            mimetype='text/calendar',
+            headers={
+                'Content-Disposition': f'{disposition}; filename="timetable_schedule.ics"'
+            }
+        )
+
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True  # Content is per-session
+    response.cache_control.max_age = ICS_CACHE_MAX_AGE
+    return response
+
+# --- Flask Routes ---
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    """Answers uploads rejected by the request's size limit in the app's JSON format."""
+    if request.max_content_length == BATCH_MAX_CONTENT_LENGTH:
+        message = f'Batch uploads must total under {BATCH_MAX_CONTENT_LENGTH // (1024 * 1024)}MB.'
+    else:
+        message = 'File size must be under 4MB.'
+    return jsonify({'success': False, 'message': message}), 413
+
+@app.route('/')
+def index():
+    """Initial route to render the main template with any existing session data."""
+    # Read-only defaults: writing them would store a session for every
+    # visitor (crawlers included) before they upload anything
+    return render_template('index.html', initial_data={
+        'timetableData': session.get('timetable_data', []),
+        'currentStep': session.get('current_step', 1)
+    })
+
+@app.route('/api/upload_and_analyze', methods=['POST'])
+def upload_and_analyze():
+    """Handles file upload, calls Groq API, and stores results in session."""
+    if 'file' not in request.files:
+        return jsonify({'success': False, 'message': 'No file part'}), 400
+
+    file = request.files['file']
+    error_message = validate_upload(file)
+    if error_message:
+        return jsonify({'success': False, 'message': error_message}), 400
+
     try:
-        response = requests.post(
+        image_parts = file_to_image_parts(file)
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'File reading/conversion error: {str(e)}'}), 500
+
+
+    # Groq API Call Logic
+    api_key = GROQ_API_KEY
+    if not api_key:
+        return jsonify({'success': False, 'message': 'GROQ_API_KEY is not configured on the server.'}), 500
+
+    payload = build_analysis_payload(image_parts)
+
+    try:
+        response = HTTP_SESSION.post(
             GROQ_API_URL,
             headers={
                 'Content-Type': 'application/json',
                 'Authorization': f'Bearer {api_key}'
             },
-            data=json.dumps(payload)
+            data=orjson.dumps(payload),
+            timeout=GROQ_TIMEOUT
         )
         response.raise_for_status()
-        result = response.json()
-        
-        # Grok response structure (OpenAI-compatible)
-        content_text = result.get('choices', [{}])[0].get('message', {}).get('content', '')
-
-        if not content_text:
-            raise ValueError("API response was empty or malformed.")
-
-        # Grok might return just the array or a wrapped object depending on prompt
-        # But we requested json_object, so it should be a valid JSON string.
-        # Robust JSON extraction: Handle markdown blocks if the AI includes them
-        import re
-        json_match = re.search(r'\{.*\}', content_text, re.DOTALL)
-        if json_match:
-            try:
-                parsed_json = json.loads(json_match.group())
-            except json.JSONDecodeError:
-                # Fallback to simple load if regex extraction fails
-                parsed_json = json.loads(content_text)
-        else:
-            parsed_json = json.loads(content_text)
-        
-        if isinstance(parsed_json, dict) and "timetable" in parsed_json:
-            valid_data = parsed_json["timetable"]
-        elif isinstance(parsed_json, list):
-            valid_data = parsed_json
-        else:
-            valid_data = [parsed_json] if isinstance(parsed_json, dict) else []
-
+        valid_data = parse_timetable_reply(orjson.loads(response.content))
 
         if not valid_data:
             return jsonify({'success': False, 'message': 'Analysis complete, but no schedule items were found.'}), 200
@@ -296,10 +555,200 @@ def upload_and_analyze():
         return jsonify({'success': False, 'message': f'Analysis failed: {str(e)}'}), 500
 
 
+@app.route('/api/upload_batch', methods=['POST'])
+def upload_batch():
+    """Queues several timetable files as one Groq batch job (cheaper, async)."""
+    # Must be raised before request.files parses the body
+    request.max_content_length = BATCH_MAX_CONTENT_LENGTH
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({'success': False, 'message': 'No file part'}), 400
+
+    if len(files) > BATCH_MAX_FILES:
+        return jsonify({'success': False, 'message': f'Upload at most {BATCH_MAX_FILES} files per batch.'}), 400
+
+    for file in files:
+        error_message = validate_upload(file)
+        if error_message:
+            return jsonify({'success': False, 'message': f'{file.filename}: {error_message}'}), 400
+
+    api_key = GROQ_API_KEY
+    if not api_key:
+        return jsonify({'success': False, 'message': 'GROQ_API_KEY is not configured on the server.'}), 500
+
+    # One JSONL line per file, in the OpenAI-compatible batch input format
+    try:
+        batch_lines = [
+            orjson.dumps({
+                "custom_id": f"req_{index}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_analysis_payload(file_to_image_parts(file))
+            })
+            for index, file in enumerate(files)
+        ]
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'File reading/conversion error: {str(e)}'}), 500
+
+    headers = {'Authorization': f'Bearer {api_key}'}
+    try:
+        upload_response = BATCH_HTTP_SESSION.post(
+            GROQ_FILES_URL,
+            headers=headers,
+            data={'purpose': 'batch'},
+            files={'file': ('timetables.jsonl', b"\n".join(batch_lines), 'application/jsonl')},
+            timeout=GROQ_TIMEOUT
+        )
+        upload_response.raise_for_status()
+        input_file_id = orjson.loads(upload_response.content)['id']
+
+        batch_response = BATCH_HTTP_SESSION.post(
+            GROQ_BATCHES_URL,
+            headers={**headers, 'Content-Type': 'application/json'},
+            data=orjson.dumps({
+                "input_file_id": input_file_id,
+                "endpoint": "/v1/chat/completions",
+                "completion_window": GROQ_BATCH_WINDOW
+            }),
+            timeout=GROQ_TIMEOUT
+        )
+        batch_response.raise_for_status()
+        batch_id = orjson.loads(batch_response.content)['id']
+
+    except requests.exceptions.HTTPError as e:
+        error_message = f"Groq API HTTP Error: {e.response.status_code} - {e.response.text}"
+        return jsonify({'success': False, 'message': error_message}), 500
+
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Batch submission failed: {str(e)}'}), 500
+
+    session['batch_id'] = batch_id
+    session['batch_files'] = [file.filename for file in files]  # Indexed by custom_id
+    session.modified = True
+
+    return jsonify({
+        'success': True,
+        'message': f'Queued {len(files)} file(s) for analysis.',
+        'batchId': batch_id
+    }), 202
+
+
+@app.route('/api/batch_status')
+def batch_status():
+    """Polls the session's Groq batch job and merges its results when done."""
+    batch_id = session.get('batch_id')
+    if not batch_id:
+        return jsonify({'success': False, 'message': 'No batch job in progress.'}), 404
+
+    api_key = GROQ_API_KEY
+    if not api_key:
+        return jsonify({'success': False, 'message': 'GROQ_API_KEY is not configured on the server.'}), 500
+
+    headers = {'Authorization': f'Bearer {api_key}'}
+    try:
+        status_response = HTTP_SESSION.get(
+            f'{GROQ_BATCHES_URL}/{batch_id}', headers=headers, timeout=GROQ_TIMEOUT
+        )
+        status_response.raise_for_status()
+        batch_job = orjson.loads(status_response.content)
+        status = batch_job.get('status')
+
+        if status in ('failed', 'expired', 'cancelled'):
+            session.pop('batch_id', None)
+            return jsonify({'success': False, 'status': status, 'message': f'Batch job {status}.'}), 200
+
+        if status != 'completed':
+            return jsonify({'success': True, 'status': status, 'message': 'Batch job still running.'}), 200
+
+        batch_files = session.get('batch_files', [])
+        output_file_id = batch_job.get('output_file_id')
+        if not output_file_id:
+            # Every request failed: the job only has an error file
+            request_counts = batch_job.get('request_counts') or {}
+            failed_count = request_counts.get('failed', len(batch_files))
+            session.pop('batch_id', None)
+            session.pop('batch_files', None)
+            return jsonify({
+                'success': False,
+                'status': status,
+                'message': f'Batch job completed, but all {failed_count} request(s) failed '
+                           f'(error file: {batch_job.get("error_file_id")}).',
+                'failedFiles': batch_files
+            }), 200
+
+        output_response = HTTP_SESSION.get(
+            f"{GROQ_FILES_URL}/{output_file_id}/content",
+            headers=headers,
+            timeout=GROQ_TIMEOUT
+        )
+        output_response.raise_for_status()
+
+        # Results may come back in any order; custom_id restores upload order
+        results = sorted(
+            (orjson.loads(line) for line in output_response.content.splitlines() if line.strip()),
+            key=lambda result: int(result['custom_id'].split('_', 1)[1])
+        )
+        merged_data = list(session.get('timetable_data', []))
+        analyzed_indexes = set()
+        for result in results:
+            result_response = result.get('response') or {}
+            if (result.get('error') or result_response.get('status_code') != 200
+                    or not result_response.get('body')):
+                continue
+            try:
+                merged_data.extend(parse_timetable_reply(result_response['body']))
+            except ValueError:
+                continue  # One unreadable reply shouldn't drop the whole batch
+            analyzed_indexes.add(int(result['custom_id'].split('_', 1)[1]))
+
+        # Failed requests may be missing from the output file entirely (they
+        # land in the error file), so compare against what was submitted
+        failed_files = [
+            filename for index, filename in enumerate(batch_files) if index not in analyzed_indexes
+        ]
+
+    except requests.exceptions.HTTPError as e:
+        error_message = f"Groq API HTTP Error: {e.response.status_code} - {e.response.text}"
+        return jsonify({'success': False, 'message': error_message}), 500
+
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Batch status check failed: {str(e)}'}), 500
+
+    session.pop('batch_id', None)
+    session.pop('batch_files', None)
+    session['timetable_data'] = merged_data
+    session['current_step'] = 2
+    session.modified = True
+
+    if failed_files:
+        message = (
+            f'Batch analysis complete, but {len(failed_files)} file(s) could not be analyzed: '
+            f'{", ".join(failed_files)}.'
+        )
+    else:
+        message = 'Batch analysis complete! Review and edit the extracted data.'
+
+    return jsonify({
+        'success': True,
+        'status': status,
+        'message': message,
+        'timetableData': merged_data,
+        'failedFiles': failed_files,
+        'currentStep': 2
+    }), 200
+
+
 @app.route('/api/update_data', methods=['POST'])
 def update_data():
     """Receives updated timetable data from the frontend and stores it."""
-    data = request.get_json()
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return jsonify({'success': False, 'message': 'Invalid JSON payload.'}), 400
+
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'Invalid data format.'}), 400
+
     new_data = data.get('timetableData', [])
     new_step = data.get('currentStep', 2)
 
@@ -308,7 +757,7 @@ def update_data():
 
     # Ensure all required keys are present (basic validation)
     for entry in new_data:
-        if not all(k in entry for k in TIMETABLE_ENTRY_SCHEMA.keys()):
+        if not isinstance(entry, dict) or not REQUIRED_ENTRY_KEYS <= entry.keys():
             return jsonify({'success': False, 'message': 'Data entry missing required fields.'}), 400
 
     session['timetable_data'] = new_data
@@ -326,28 +775,7 @@ def download_ics():
     if not timetable_data:
         return "Timetable data is empty.", 400
 
-    app_id = "flask-timetable-pro" 
-    ics_content = generate_ics_content(timetable_data, app_id)
-
-    temp_filename = 'timetable_schedule.ics'
-    with open(temp_filename, 'w') as f:
-        f.write(ics_content)
-    
-    response = send_file(
-        temp_filename,
-        mimetype='text/calendar',
-        as_attachment=True,
-        download_name='timetable_schedule.ics'
-    )
-
-    @response.call_on_close
-    def remove_file():
-        try:
-            os.remove(temp_filename)
-        except OSError:
-            pass
-            
-    return response
+    return ics_response(timetable_data, 'attachment')
 
 
 @app.route('/open_ics')
@@ -358,17 +786,7 @@ def open_ics():
     if not timetable_data:
         return "Timetable data is empty.", 400
 
-    app_id = "flask-timetable-pro"
-    ics_content = generate_ics_content(timetable_data, app_id)
-
-    from flask import Response
-    return Response(
-        ics_content,
-        mimetype='text/calendar',
-        headers={
-            'Content-Disposition': 'inline; filename="timetable_schedule.ics"'
-        }
-    )
+    return ics_response(timetable_data, 'inline')
 
 from flask import render_template
 
@@ -0,0 +1,13 @@
+# Gunicorn settings (picked up automatically when started from this directory)
+import os
+
+# A Groq analysis can take 5-30 s of pure network wait. Threaded workers let
+# that wait hold a single thread instead of a whole worker process, so many
+# uploads can be analyzed concurrently.
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+# Must outlast a Groq call: up to 3 x 5 s connect attempts plus the 60 s
+# read timeout (completion POSTs are never retried after being sent)
+timeout = 120